@@ -1,15 +1,74 @@
 # bot.py
+import asyncio
+import math
+import os
 import re
-from collections import defaultdict
-from dataclasses import dataclass
-from datetime import datetime
-from typing import Optional, Tuple
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import lru_cache
+from itertools import groupby
+from typing import Dict, NamedTuple, Optional, Tuple
+from urllib.parse import urlparse
 
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from telegram import Update
-
-
-@dataclass
+from telegram import Message, Update
+
+# received: 70 #usdt ($70) from ...
+# Сумма принимается только в виде, который понимает float() (70, 0.5, 70., .5),
+# поэтому отдельная проверка через try/except не нужна.
+# Применяется к строке, уже приведенной к нижнему регистру, поэтому без IGNORECASE
+_RE_AMOUNT_CURRENCY = re.compile(
+    r'received:\s*(\d+(?:\.\d*)?|\.\d+)(?![\d.])\s*#?([a-z0-9]{2,})'
+)
+
+# from 0xef3a...13b20 OR from TMJnLC...UfGb OR from MEXC Hot wallet
+_RE_FROM_TOKEN = re.compile(r'\bfrom\s+([^\s\(\|]+)', re.IGNORECASE)
+
+# Address links (full addresses): одна регулярка на все эксплореры,
+# имя сработавшей группы (m.lastgroup) — это сеть
+_RE_ADDRESS_LINK = re.compile(
+    r'tronscan\.org/#/address/(?P<TRON>[A-Za-z0-9]{20,})'
+    r'|bscscan\.com/address/(?P<BSC>0x[a-fA-F0-9]{40})'
+    r'|etherscan\.io/address/(?P<ETH>0x[a-fA-F0-9]{40})',
+    re.IGNORECASE
+)
+
+# Маркер строки с транзакцией — ищется без копии текста в нижнем регистре
+_RE_RECEIVED = re.compile(r'received:', re.IGNORECASE)
+
+# Есть ли в строке хоть одна цифра: без нее суммы в строке Received быть не может
+_HAS_DIGIT = re.compile(r'\d').search
+
+# Network tags like "#bnb |" or "#tron |" (ищем в строке, приведенной к нижнему регистру)
+_RE_NETWORK_TAG = re.compile(r'#(bnb|tron|eth)\b')
+
+# Названия сетей в хештеге (ethereum и solana покрываются eth и sol)
+_HASHTAG_NETWORKS = {
+    'trc20': "TRON",
+    'tron': "TRON",
+    'bnb': "BSC",
+    'eth': "ETH",
+    'btc': "BTC",
+    'bitcoin': "BTC",
+    'sol': "SOL",
+}
+# Если в хештеге несколько сетей, побеждает первая из этого списка
+_HASHTAG_NETWORK_PRIORITY = ("TRON", "BSC", "ETH", "BTC", "SOL")
+_RE_HASHTAG_NETWORK = re.compile('|'.join(_HASHTAG_NETWORKS))
+
+# Непустая строка сообщения без окружающих пробелов (один проход по всему тексту).
+# Ведущие пробелы не переходят через \n, а конец строки — жадный [^\n]*\S без ленивого тела:
+# так длинные серии пробелов и пустых строк разбираются за линейное время
+_RE_LINE = re.compile(r'^[^\S\n]*(\S(?:[^\n]*\S)?)', re.MULTILINE)
+
+# Голые теги сетей — это не хештег кошелька
+_SIMPLE_NETWORK_TAGS = frozenset({'#bnb', '#tron', '#eth', '#btc', '#sol'})
+
+# Разделитель в отчете /finish_count
+_REPORT_SEPARATOR = "─" * 40
+
+
+@dataclass(slots=True)
 class PendingTx:
     amount: float
     currency: str
@@ -19,263 +78,278 @@ class PendingTx:
     hashtag: Optional[str] = None
 
 
-class TransactionCalculator:
-    def __init__(self):
-        # transactions[hashtag][currency] = sum_amount
-        # hashtag хранится как есть, например "#oscar max bnb"
-        self.transactions = defaultdict(lambda: defaultdict(float))
-        self.total_transactions = 0  # количество обработанных строк Received
-        self.wallets_seen = set()  # для подсчета уникальных кошельков
-
-        # Примерные курсы для суммы в USD (можете менять)
-        self.rates = {
-            'USDT': 1.0,
-            'USDC': 1.0,
-            'BNB': 886.0,
-            'TRX': 0.12,
-            'ETH': 3500.0,
-            'BTC': 68000.0,
-            'SOL': 150.0,
-        }
+class ParsedTx(NamedTuple):
+    """Одна распознанная транзакция: ключ группировки, валюта, сумма и кошелек"""
+    hashtag_key: str
+    currency: str
+    amount: float
+    wallet: str
 
-        # Received: 70 #USDT ($70) from ...
-        self._re_amount_currency = re.compile(
-            r'Received:\s*([\d.]+)\s*#?([A-Za-z0-9]{2,})',
-            re.IGNORECASE
-        )
 
-        # from 0xef3a...13b20 OR from TMJnLC...UfGb OR from MEXC Hot wallet
-        self._re_from_token = re.compile(r'\bfrom\s+([^\s\(\|]+)', re.IGNORECASE)
+# ---------- parsing helpers ----------
 
-        # Address links (full addresses)
-        self._re_bscscan_addr = re.compile(r'bscscan\.com/address/(0x[a-fA-F0-9]{40})', re.IGNORECASE)
-        self._re_etherscan_addr = re.compile(r'etherscan\.io/address/(0x[a-fA-F0-9]{40})', re.IGNORECASE)
-        self._re_tronscan_addr = re.compile(r'tronscan\.org/#/address/([A-Za-z0-9]{20,})', re.IGNORECASE)
 
-        # Network tags like "#bnb |" or "#tron |"
-        self._re_network_tag = re.compile(r'#(bnb|tron|eth)\b', re.IGNORECASE)
-        
-        # Хештег в формате #something ... network (например, #oscar max bnb, #oscar max trc20)
-        self._re_hashtag = re.compile(r'#([^\s]+(?:\s+[^\s]+)*)', re.IGNORECASE)
-
-    # ---------- parsing helpers ----------
-
-    def _extract_hashtag_from_text(self, text: str) -> Optional[str]:
-        """Извлекает хештег из текста (например, #oscar max bnb)"""
-        lines = text.strip().split('\n')
-        for line in lines:
-            line = line.strip()
-            # Пропускаем строки с "Received:" и служебные строки
-            if 'received:' in line.lower() or 'переслано' in line.lower() or 'forwarded' in line.lower():
-                continue
-            # Ищем хештег в начале строки
-            if line.startswith('#'):
-                # Если в строке есть |, берем только часть до |
-                if '|' in line:
-                    line = line.split('|')[0].strip()
-                # Извлекаем весь хештег (может быть многословным: #oscar max bnb)
-                # Берем все слова, начинающиеся с #
-                parts = line.split()
-                if parts and parts[0].startswith('#'):
-                    hashtag = ' '.join(parts)  # Берем все слова как хештег
-                    hashtag_lower = hashtag.lower()
-                    # Проверяем, что это не просто тег сети (#bnb, #tron)
-                    simple_tags = ['#bnb', '#tron', '#eth', '#btc', '#sol']
-                    if hashtag_lower not in simple_tags:
-                        # Если хештег содержит пробелы (многословный) или длиннее простого тега - это хештег кошелька
-                        if ' ' in hashtag or len(hashtag) > 5:
-                            return hashtag
+def _extract_hashtag_from_text(text: str) -> Optional[str]:
+    """Извлекает хештег из текста (например, #oscar max bnb)"""
+    # Без '#' хештега нет — текст не разбиваем на строки вовсе
+    if '#' not in text:
         return None
-
-    def _detect_network_from_hashtag(self, hashtag: str) -> str:
-        """Определяет сеть из хештега (например, #oscar max bnb -> BSC, #oscar max trc20 -> TRON)"""
+    # Строки перебираются лениво: на первом найденном хештеге остаток текста не разбивается
+    for m in _RE_LINE.finditer(text):
+        line = m.group(1)
+        # Ищем хештег в начале строки; остальные строки отбрасываем сразу
+        if line.startswith('#'):
+            hashtag = _extract_hashtag_from_line(line)
+            if hashtag:
+                return hashtag
+    return None
+
+
+# Строки с хештегами повторяются из сообщения в сообщение — кэшируются только они,
+# а не целые сообщения (те почти всегда разные и заняли бы кэш пересланными данными)
+@lru_cache(maxsize=1024)
+def _extract_hashtag_from_line(line: str) -> Optional[str]:
+    """Хештег из одной строки, начинающейся с # (строка уже без окружающих пробелов)"""
+    # Пропускаем строки с "Received:" и служебные строки
+    line_l = line.lower()
+    if 'received:' in line_l or 'переслано' in line_l or 'forwarded' in line_l:
+        return None
+    # Если в строке есть |, берем только часть до |
+    if '|' in line:
+        line = line.split('|')[0].strip()
+    # Извлекаем весь хештег (может быть многословным: #oscar max bnb)
+    # Берем все слова, начинающиеся с #
+    parts = line.split()
+    if parts and parts[0].startswith('#'):
+        hashtag = ' '.join(parts)  # Берем все слова как хештег
         hashtag_lower = hashtag.lower()
-        
-        # Проверяем различные варианты сетей в хештеге
-        if 'trc20' in hashtag_lower or 'tron' in hashtag_lower:
-            return "TRON"
-        if 'bnb' in hashtag_lower:
-            return "BSC"
-        if 'eth' in hashtag_lower or 'ethereum' in hashtag_lower:
-            return "ETH"
-        if 'btc' in hashtag_lower or 'bitcoin' in hashtag_lower:
-            return "BTC"
-        if 'sol' in hashtag_lower or 'solana' in hashtag_lower:
-            return "SOL"
-        
-        return "UNKNOWN"
-
-    def _detect_network_from_line(self, line: str) -> str:
-        line_l = line.lower()
+        # Проверяем, что это не просто тег сети (#bnb, #tron)
+        if hashtag_lower not in _SIMPLE_NETWORK_TAGS:
+            # Если хештег содержит пробелы (многословный) или длиннее простого тега - это хештег кошелька
+            if ' ' in hashtag or len(hashtag) > 5:
+                return hashtag
+    return None
+
+
+@lru_cache(maxsize=1024)
+def _detect_network_from_hashtag(hashtag: str) -> str:
+    """Определяет сеть из хештега (например, #oscar max bnb -> BSC, #oscar max trc20 -> TRON)"""
+    # Один проход регуляркой собирает все названия сетей, дальше выбираем по приоритету
+    found = {_HASHTAG_NETWORKS[m.group(0)] for m in _RE_HASHTAG_NETWORK.finditer(hashtag.lower())}
+    for network in _HASHTAG_NETWORK_PRIORITY:
+        if network in found:
+            return network
+    return "UNKNOWN"
+
+
+def _detect_network_from_line(line_l: str) -> str:
+    """Сеть по ссылке на address или по тегу сети (строка передается в нижнем регистре)"""
+    if '/address/' in line_l:
+        m = _RE_ADDRESS_LINK.search(line_l)
+        if m:
+            return m.lastgroup
 
-        if self._re_tronscan_addr.search(line):
+    # fallback: tags
+    m = _RE_NETWORK_TAG.search(line_l)
+    if m:
+        tag = m.group(1)
+        if tag == "tron":
             return "TRON"
-        if self._re_bscscan_addr.search(line):
+        if tag == "bnb":
             return "BSC"
-        if self._re_etherscan_addr.search(line):
+        if tag == "eth":
             return "ETH"
 
-        # fallback: tags
-        m = self._re_network_tag.search(line)
-        if m:
-            tag = m.group(1).lower()
-            if tag == "tron":
-                return "TRON"
-            if tag == "bnb":
-                return "BSC"
-            if tag == "eth":
-                return "ETH"
-
-        return "UNKNOWN"
-
-    def _extract_full_wallet_from_links(self, line: str) -> Tuple[Optional[str], Optional[str]]:
-        """
-        Возвращает (network, full_wallet) если нашли ссылку на address.
-        """
-        m = self._re_tronscan_addr.search(line)
-        if m:
-            return "TRON", m.group(1)
+    return "UNKNOWN"
 
-        m = self._re_bscscan_addr.search(line)
-        if m:
-            return "BSC", m.group(1)
 
-        m = self._re_etherscan_addr.search(line)
-        if m:
-            return "ETH", m.group(1)
+def _extract_full_wallet_from_links(line: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Возвращает (network, full_wallet) если нашли ссылку на address.
+    """
+    m = _RE_ADDRESS_LINK.search(line)
+    if m:
+        return m.lastgroup, m.group(m.lastgroup)
+    return None, None
 
+
+def _extract_amount_currency(line_l: str) -> Tuple[Optional[float], Optional[str]]:
+    """Сумма и валюта из строки Received (строка передается в нижнем регистре)"""
+    m = _RE_AMOUNT_CURRENCY.search(line_l)
+    if not m:
         return None, None
+    return float(m.group(1)), m.group(2).upper()
 
-    def _extract_amount_currency(self, line: str) -> Tuple[Optional[float], Optional[str]]:
-        m = self._re_amount_currency.search(line)
-        if not m:
-            return None, None
-        try:
-            amount = float(m.group(1))
-            currency = m.group(2).upper()
-            return amount, currency
-        except ValueError:
-            return None, None
-
-    def _extract_wallet_short(self, line: str) -> Optional[str]:
-        m = self._re_from_token.search(line)
-        if not m:
-            return None
-        return m.group(1).strip()
 
-    # ---------- core logic ----------
+def _extract_wallet_short(line: str) -> Optional[str]:
+    m = _RE_FROM_TOKEN.search(line)
+    if not m:
+        return None
+    return m.group(1).strip()
+
+
+@lru_cache(maxsize=256)
+def _parse_transactions(text: str, global_hashtag: Optional[str] = None) -> Tuple[ParsedTx, ...]:
+    """
+    Разбирает сообщение в кортеж транзакций. Функция чистая (зависит только от text),
+    поэтому повторно пересланный тот же блок не разбирается заново.
+    global_hashtag — уже найденный в text хештег, чтобы не искать его второй раз.
+    """
+    parsed = []
+    pending: Optional[PendingTx] = None
+    current_hashtag = None
+    network_from_hashtag = None
+    
+    # Сначала ищем хештег во всем тексте (для случая одного хештега на все транзакции)
+    if global_hashtag is None:
+        global_hashtag = _extract_hashtag_from_text(text)
+    if global_hashtag:
+        network_from_hashtag = _detect_network_from_hashtag(global_hashtag)
+
+    def finalize_pending():
+        nonlocal pending
+        if not pending:
+            return
 
-    def add_transactions(self, text: str) -> int:
-        lines = text.strip().split('\n')
-        added = 0
-        pending: Optional[PendingTx] = None
-        current_hashtag = None
-        network_from_hashtag = None
-        
-        # Сначала ищем хештег во всем тексте (для случая одного хештега на все транзакции)
-        global_hashtag = self._extract_hashtag_from_text(text)
-        if global_hashtag:
-            network_from_hashtag = self._detect_network_from_hashtag(global_hashtag)
-
-        def finalize_pending():
-            nonlocal pending, added
-            if not pending:
-                return
-
-            # Используем хештег для группировки, если он есть
-            if pending.hashtag:
-                hashtag_key = pending.hashtag
-            else:
-                # Если хештега нет, используем сеть как ключ (fallback)
-                hashtag_key = f"#{pending.network}"
-
-            # Добавляем транзакцию по хештегу
-            self.transactions[hashtag_key][pending.currency] += pending.amount
-            self.total_transactions += 1
-            added += 1
-            
-            # Сохраняем кошелек для статистики
-            wallet = pending.wallet_full or pending.wallet_short
-            if wallet:
-                self.wallets_seen.add(wallet)
-            
-            pending = None
-
-        for i, raw in enumerate(lines):
-            line = raw.strip()
-            if not line:
+        # Используем хештег для группировки, если он есть
+        if pending.hashtag:
+            hashtag_key = pending.hashtag
+        else:
+            # Если хештега нет, используем сеть как ключ (fallback)
+            hashtag_key = f"#{pending.network}"
+
+        # Добавляем транзакцию по хештегу, кошелек сохраняем для статистики
+        parsed.append(ParsedTx(
+            hashtag_key, pending.currency, pending.amount,
+            pending.wallet_full or pending.wallet_short
+        ))
+        pending = None
+
+    for m in _RE_LINE.finditer(text):
+        line = m.group(1)
+
+        # Проверяем, является ли строка хештегом
+        if line.startswith('#') and '|' not in line:
+            # Ищем хештег в этой строке
+            potential_hashtag = _extract_hashtag_from_line(line)
+            if potential_hashtag:
+                current_hashtag = potential_hashtag
+                network_from_hashtag = _detect_network_from_hashtag(potential_hashtag)
+            continue
+
+        # Пока нет pending, строка без Received ничего не меняет — отбрасываем ее без копии в нижнем регистре
+        if pending is None and _RE_RECEIVED.search(line) is None:
+            continue
+
+        line_l = line.lower()
+        # Ссылки на address ищем регулярками только если подстрока вообще есть в строке
+        has_address_link = '/address/' in line_l
+
+        # Если пришла строка Received — сначала закрываем прошлую pending, потом создаём новую
+        if 'received:' in line_l:
+            finalize_pending()
+
+            # Без "from" кошелек не найти, без цифр нет суммы — такую строку отбрасываем до запуска регулярок
+            if 'from' not in line_l or not _HAS_DIGIT(line_l):
                 continue
 
-            # Проверяем, является ли строка хештегом
-            if line.startswith('#') and '|' not in line:
-                # Ищем хештег в этой строке
-                potential_hashtag = self._extract_hashtag_from_text(line)
-                if potential_hashtag:
-                    current_hashtag = potential_hashtag
-                    network_from_hashtag = self._detect_network_from_hashtag(potential_hashtag)
+            amount, currency = _extract_amount_currency(line_l)
+            if amount is None or currency is None:
                 continue
 
-            # Если пришла строка Received — сначала закрываем прошлую pending, потом создаём новую
-            if 'received:' in line.lower():
-                finalize_pending()
-
-                amount, currency = self._extract_amount_currency(line)
-                if amount is None or currency is None:
-                    continue
-
-                wallet_short = self._extract_wallet_short(line)
-                if not wallet_short:
-                    continue
-
-                # пытаемся взять полный адрес прямо из этой же строки
-                net_link, wallet_full = self._extract_full_wallet_from_links(line)
-
-                # Используем текущий хештег или глобальный
-                hashtag_to_use = current_hashtag or global_hashtag
-
-                # сеть определим: сначала из хештега, потом по ссылке, иначе по тегу/прочему
-                if network_from_hashtag and network_from_hashtag != "UNKNOWN":
-                    network = network_from_hashtag
-                elif net_link:
-                    network = net_link
-                else:
-                    network = self._detect_network_from_line(line)
-
-                # если полный адрес уже есть — добавляем сразу, pending не нужен
-                if wallet_full:
-                    hashtag_key = hashtag_to_use if hashtag_to_use else f"#{network}"
-                    self.transactions[hashtag_key][currency] += amount
-                    self.total_transactions += 1
-                    added += 1
-                    self.wallets_seen.add(wallet_full)
-                    pending = None
-                else:
-                    pending = PendingTx(
-                        amount=amount,
-                        currency=currency,
-                        network=network,
-                        wallet_short=wallet_short,
-                        wallet_full=None,
-                        hashtag=hashtag_to_use
-                    )
+            wallet_short = _extract_wallet_short(line)
+            if not wallet_short:
                 continue
 
-            # НЕ Received строка: если есть pending — попробуем подцепить полный address ссылкой
-            if pending:
-                net_link, wallet_full = self._extract_full_wallet_from_links(line)
-                if wallet_full:
-                    pending.wallet_full = wallet_full
-                    # если сеть из ссылки точнее — обновим
-                    if net_link and pending.network == "UNKNOWN":
-                        pending.network = net_link
-                else:
-                    # иногда тег сети приходит отдельной строкой
-                    if pending.network == "UNKNOWN":
-                        pending.network = self._detect_network_from_line(line)
-
-        # в конце закрываем pending, если осталась
-        finalize_pending()
-        return added
+            # пытаемся взять полный адрес прямо из этой же строки
+            if has_address_link:
+                net_link, wallet_full = _extract_full_wallet_from_links(line)
+            else:
+                net_link, wallet_full = None, None
+
+            # Используем текущий хештег или глобальный
+            hashtag_to_use = current_hashtag or global_hashtag
+
+            # сеть определим: сначала из хештега, потом по ссылке, иначе по тегу/прочему
+            if network_from_hashtag and network_from_hashtag != "UNKNOWN":
+                network = network_from_hashtag
+            elif net_link:
+                network = net_link
+            else:
+                network = _detect_network_from_line(line_l)
+
+            # если полный адрес уже есть — добавляем сразу, pending не нужен
+            if wallet_full:
+                hashtag_key = hashtag_to_use if hashtag_to_use else f"#{network}"
+                parsed.append(ParsedTx(hashtag_key, currency, amount, wallet_full))
+                pending = None
+            else:
+                pending = PendingTx(
+                    amount=amount,
+                    currency=currency,
+                    network=network,
+                    wallet_short=wallet_short,
+                    wallet_full=None,
+                    hashtag=hashtag_to_use
+                )
+            continue
+
+        # НЕ Received строка: если есть pending — попробуем подцепить полный address ссылкой
+        if pending:
+            if has_address_link:
+                net_link, wallet_full = _extract_full_wallet_from_links(line)
+            else:
+                net_link, wallet_full = None, None
+            if wallet_full:
+                pending.wallet_full = wallet_full
+                # если сеть из ссылки точнее — обновим
+                if net_link and pending.network == "UNKNOWN":
+                    pending.network = net_link
+            else:
+                # иногда тег сети приходит отдельной строкой
+                if pending.network == "UNKNOWN":
+                    pending.network = _detect_network_from_line(line_l)
+
+    # в конце закрываем pending, если осталась
+    finalize_pending()
+    return tuple(parsed)
+
+
+class TransactionCalculator:
+    def __init__(self):
+        # transactions[(hashtag, currency)] = sum_amount — плоский словарь, одна проба на транзакцию
+        # hashtag хранится как есть, например "#oscar max bnb"
+        self.transactions: Dict[Tuple[str, str], float] = {}
+        self.total_transactions = 0  # количество обработанных строк Received
+        self.wallets_seen = set()  # для подсчета уникальных кошельков
+
+        # Примерные курсы для суммы в USD (можете менять)
+        self.rates = {
+            'USDT': 1.0,
+            'USDC': 1.0,
+            'BNB': 886.0,
+            'TRX': 0.12,
+            'ETH': 3500.0,
+            'BTC': 68000.0,
+            'SOL': 150.0,
+        }
+
+    # ---------- core logic ----------
+
+    def add_transactions(self, text: str, global_hashtag: Optional[str] = None) -> int:
+        parsed = _parse_transactions(text, global_hashtag)
+        # Суммы сообщения сначала складываются в локальный словарь,
+        # в общие итоги по хештегу — одна запись на каждую пару (хештег, валюта)
+        totals: Dict[Tuple[str, str], float] = {}
+        for tx in parsed:
+            key = (tx.hashtag_key, tx.currency)
+            totals[key] = totals.get(key, 0.0) + tx.amount
+        for key, amount in totals.items():
+            self.transactions[key] = self.transactions.get(key, 0.0) + amount
+
+        self.total_transactions += len(parsed)
+        self.wallets_seen.update(tx.wallet for tx in parsed if tx.wallet)
+        return len(parsed)
 
     def clear_all(self):
         self.transactions.clear()
@@ -296,54 +370,132 @@ class TransactionCalculator:
             return "📭 Нет транзакций для отчёта."
 
         report = []
-        total_all_usd = 0.0
+        usd_parts = []
+        rates_get = self.rates.get
 
-        # Сортируем хештеги для красивого вывода
-        hashtags = sorted(self.transactions.keys())
+        # Сортировка по (хештег, валюта) и группировка по хештегу для вывода блоками
+        for hashtag, group in groupby(sorted(self.transactions.items()), key=lambda kv: kv[0][0]):
+            cur_items = [(cur, amt) for (_, cur), amt in group]
 
-        for hashtag in hashtags:
-            currencies = self.transactions[hashtag]
-            hashtag_total_usd = 0.0
-            
-            # Выводим хештег
+            # Выводим хештег и суммы по валютам одним блоком
             report.append(hashtag)
-            
-            # Выводим суммы по валютам
-            for cur in sorted(currencies.keys()):
-                amt = currencies[cur]
-                report.append(f"{amt:.2f} {cur}")
-                if cur in self.rates:
-                    hashtag_total_usd += amt * self.rates[cur]
-            
-            total_all_usd += hashtag_total_usd
-
-        # Разделитель
-        report.append("─" * 40)
-        
-        # Общая статистика
-        report.append("📈 ОБЩАЯ СТАТИСТИКА:")
-        wallet_count = len(self.wallets_seen)
-        report.append(f"• Кошельков: {wallet_count}")
-        report.append(f"• Транзакций: {self.total_transactions}")
-        report.append(f"• Общая сумма: ${total_all_usd:.2f} USD")
+            report.extend("%.2f %s" % (amt, cur) for cur, amt in cur_items)
+
+            # Валюты без курса в сумму USD не входят; курс берется одним обращением к словарю
+            usd_parts.extend(
+                amt * rate for cur, amt in cur_items if (rate := rates_get(cur)) is not None
+            )
+
+        # fsum складывает без накопления ошибки округления, сколько бы слагаемых ни было
+        total_all_usd = math.fsum(usd_parts)
+
+        # Разделитель и общая статистика
+        report.extend((
+            _REPORT_SEPARATOR,
+            "📈 ОБЩАЯ СТАТИСТИКА:",
+            f"• Кошельков: {len(self.wallets_seen)}",
+            f"• Транзакций: {self.total_transactions}",
+            f"• Общая сумма: ${total_all_usd:.2f} USD",
+        ))
 
         return "\n".join(report)
 
 
+@dataclass
+class UserSession:
+    """Состояние одного пользователя: свой калькулятор, последний хештег и лок для последовательной обработки"""
+    # Разбор текста идет в отдельном потоке, поэтому все обращения к calculator — под локом
+    calculator: TransactionCalculator = field(default_factory=TransactionCalculator)
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    # Хештег из сообщения "только с хештегом" — подставляется к транзакциям без своего хештега
+    last_hashtag: Optional[str] = None
+
+
+# Обычный текст (не команда) — собирается один раз при импорте модуля
+_TEXT_FILTER = filters.TEXT & ~filters.COMMAND
+
+
 class TransactionBot:
+    # Сколько сессий держать, чтобы память не росла бесконечно. Вытесняются только пустые и свободные
+    # сессии, поэтому при множестве пользователей с несданными итогами лимит может быть превышен
+    MAX_TRACKED_USERS = 10_000
+    # Ответы на сообщения, пришедшие подряд в пределах этой паузы, склеиваются в один
+    STATUS_DEBOUNCE_SECONDS = 0.5
+    # Сообщения короче этого разбираются прямо в event loop: переход в поток стоит дороже самого разбора
+    INLINE_PARSE_MAX_CHARS = 500
+
     def __init__(self, token: str):
-        self.calculator = TransactionCalculator()
+        # user_id -> своя сессия у каждого пользователя; при переполнении вытесняется самая давняя пустая
+        self.sessions: OrderedDict = OrderedDict()
         self.application = Application.builder().token(token).build()
-        self.last_hashtag = {}  # user_id -> hashtag для хранения последнего хештега пользователя
+        # user_id -> отложенный ответ со статусом и сколько транзакций он должен подтвердить
+        self._pending_status: Dict[int, asyncio.Task] = {}
+        self._pending_added: Dict[int, int] = {}
         self._setup_handlers()
 
     def _setup_handlers(self):
-        self.application.add_handler(CommandHandler("start", self._start))
-        self.application.add_handler(CommandHandler("help", self._help))
-        self.application.add_handler(CommandHandler("status", self._status))
-        self.application.add_handler(CommandHandler("finish_count", self._finish))
-        self.application.add_handler(CommandHandler("clear", self._clear))
-        self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self._handle_text))
+        # Справка и статус ничего не меняют — их ответы не должны задерживать следующие апдейты
+        self.application.add_handler(CommandHandler("start", self._start, block=False))
+        self.application.add_handler(CommandHandler("help", self._help, block=False))
+        self.application.add_handler(CommandHandler("status", self._status, block=False))
+        # Все обработчики, меняющие состояние пользователя, тоже неблокирующие: PTB запускает их задачи
+        # в порядке прихода апдейтов, и первым await каждого идет UserSession.lock (FIFO).
+        # Блокирующий /finish_count рядом с неблокирующим текстом обогнал бы еще не начатые задачи.
+        # Поэтому все чтения и изменения calculator и last_hashtag сессии — только под этим локом.
+        self.application.add_handler(CommandHandler("finish_count", self._finish, block=False))
+        self.application.add_handler(CommandHandler("clear", self._clear, block=False))
+        self.application.add_handler(MessageHandler(_TEXT_FILTER, self._handle_text, block=False))
+
+    def _session(self, user_id: int) -> UserSession:
+        session = self.sessions.get(user_id)
+        if session is None:
+            if len(self.sessions) >= self.MAX_TRACKED_USERS:
+                self._evict_idle_session()
+            session = self.sessions[user_id] = UserSession()
+        self.sessions.move_to_end(user_id)
+        return session
+
+    def _evict_idle_session(self):
+        """Удаляет самую давнюю сессию без данных: несданные итоги, хештег и занятый лок не теряются"""
+        for user_id, session in self.sessions.items():
+            if session.lock.locked() or session.calculator.transactions or session.last_hashtag:
+                continue
+            del self.sessions[user_id]
+            return
+
+    def _schedule_status(self, user_id: int, message: Message, added: int):
+        """Откладывает ответ со статусом; новое сообщение пользователя переносит его и суммирует added"""
+        self._pending_added[user_id] = self._pending_added.get(user_id, 0) + added
+        task = self._pending_status.pop(user_id, None)
+        if task:
+            task.cancel()
+        self._pending_status[user_id] = self.application.create_task(
+            self._flush_status(user_id, message)
+        )
+
+    def _cancel_status(self, user_id: int):
+        task = self._pending_status.pop(user_id, None)
+        if task:
+            task.cancel()
+        self._pending_added.pop(user_id, None)
+
+    async def _flush_status(self, user_id: int, message: Message):
+        await asyncio.sleep(self.STATUS_DEBOUNCE_SECONDS)
+        # До первого await после паузы: новые сообщения уже пойдут в следующий ответ
+        del self._pending_status[user_id]
+        added = self._pending_added.pop(user_id, 0)
+        session = self._session(user_id)
+        async with session.lock:
+            st = session.calculator.get_status()
+        if not st:
+            return
+        await message.reply_text(
+            f"✅ Обработано транзакций: {added}\n\n"
+            f"📊 Статус:\n"
+            f"• Кошельков: {st['wallet_count']}\n"
+            f"• Всего транзакций: {st['transaction_count']}\n\n"
+            f"💡 Жмите /finish_count для отчёта"
+        )
 
     async def _start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(
@@ -366,7 +518,9 @@ class TransactionBot:
         )
 
     async def _status(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        st = self.calculator.get_status()
+        session = self._session(update.effective_user.id)
+        async with session.lock:
+            st = session.calculator.get_status()
         if not st:
             await update.message.reply_text("📭 Нет активных транзакций. Пришлите транзакции, чтобы начать.")
             return
@@ -379,20 +533,28 @@ class TransactionBot:
 
     async def _clear(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
-        self.calculator.clear_all()
-        if user_id in self.last_hashtag:
-            del self.last_hashtag[user_id]
+        session = self._session(user_id)
+        async with session.lock:
+            self._cancel_status(user_id)
+            session.calculator.clear_all()
+            session.last_hashtag = None
         await update.message.reply_text("✅ Все транзакции очищены. Можно начинать заново!")
 
     async def _finish(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        if not self.calculator.transactions:
+        user_id = update.effective_user.id
+        session = self._session(user_id)
+        async with session.lock:
+            # Отчет заменяет отложенное подтверждение
+            self._cancel_status(user_id)
+            if session.calculator.transactions:
+                report = session.calculator.get_total_report()
+                session.calculator.clear_all()
+                session.last_hashtag = None
+            else:
+                report = None
+        if report is None:
             await update.message.reply_text("📭 Пока нет транзакций. Пришлите данные.")
             return
-        user_id = update.effective_user.id
-        report = self.calculator.get_total_report()
-        self.calculator.clear_all()
-        if user_id in self.last_hashtag:
-            del self.last_hashtag[user_id]
         report += "\n\n✅ Отчет готов! Присылайте новые транзакции для следующего расчета."
         await update.message.reply_text(report)
 
@@ -401,47 +563,51 @@ class TransactionBot:
         text = update.message.text
         
         # Проверяем, является ли сообщение только хештегом (без транзакций)
-        hashtag = self.calculator._extract_hashtag_from_text(text)
-        has_received = 'received:' in text.lower()
+        hashtag = _extract_hashtag_from_text(text)
+        has_received = _RE_RECEIVED.search(text) is not None
         
         if hashtag and not has_received:
             # Сообщение содержит только хештег(и) - сохраняем последний
-            lines = text.strip().split('\n')
             saved_hashtags = []
-            for line in lines:
-                line = line.strip()
+            for m in _RE_LINE.finditer(text):
+                line = m.group(1)
                 if line.startswith('#'):
-                    h = self.calculator._extract_hashtag_from_text(line)
+                    h = _extract_hashtag_from_line(line)
                     if h:
                         saved_hashtags.append(h)
-                        self.last_hashtag[user_id] = h
             if saved_hashtags:
+                # Под локом: хештег не должен обогнать еще не обработанные /finish_count и /clear
+                session = self._session(user_id)
+                async with session.lock:
+                    session.last_hashtag = saved_hashtags[-1]
                 hashtags_text = '\n'.join(saved_hashtags)
                 await update.message.reply_text(
                     f"✅ Хештег(и) сохранён(ы):\n{hashtags_text}\n\n"
-                    f"💡 Будет использован последний: {self.last_hashtag[user_id]}\n"
+                    f"💡 Будет использован последний: {saved_hashtags[-1]}\n"
                     f"Теперь пришлите транзакции для этого хештега."
                 )
             else:
                 await update.message.reply_text("❌ Не удалось распознать хештег.")
             return
         
-        # Если есть сохраненный хештег и в тексте нет хештега, добавляем его в начало
-        if self.last_hashtag.get(user_id) and not hashtag:
-            text = f"{self.last_hashtag[user_id]}\n{text}"
-            hashtag = self.last_hashtag[user_id]
-        
-        added = self.calculator.add_transactions(text)
-        if added > 0:
-            st = self.calculator.get_status()
-            await update.message.reply_text(
-                f"✅ Обработано транзакций: {added}\n\n"
-                f"📊 Статус:\n"
-                f"• Кошельков: {st['wallet_count']}\n"
-                f"• Всего транзакций: {st['transaction_count']}\n\n"
-                f"💡 Жмите /finish_count для отчёта"
-            )
-        else:
+        session = self._session(user_id)
+        async with session.lock:
+            # Если есть сохраненный хештег и в тексте нет хештега, добавляем его в начало
+            saved_hashtag = session.last_hashtag
+            if saved_hashtag and not hashtag:
+                text = f"{saved_hashtag}\n{text}"
+                hashtag = saved_hashtag
+
+            # Длинные пересланные логи разбираем вне event loop, чтобы не задерживать других пользователей;
+            # уже найденный хештег передаем дальше, чтобы текст не сканировался повторно
+            if len(text) < self.INLINE_PARSE_MAX_CHARS:
+                added = session.calculator.add_transactions(text, hashtag)
+            else:
+                added = await asyncio.to_thread(session.calculator.add_transactions, text, hashtag)
+            if added > 0:
+                # Несколько пересланных подряд сообщений подтверждаем одним ответом
+                self._schedule_status(user_id, update.message, added)
+        if not added:
             await update.message.reply_text(
                 "❌ Не удалось распознать транзакции.\n\n"
                 "Нужна строка вида:\n"
@@ -449,4 +615,24 @@ class TransactionBot:
             )
 
     def run(self):
-        self.application.run_polling()
+        # Бот работает только с обычными сообщениями — остальные типы апдейтов Telegram не присылает.
+        # Если задан WEBHOOK_URL, апдейты приходят по HTTPS вместо long polling; настройки webhook
+        # читаются только здесь, чтобы в режиме polling они ни на что не влияли
+        webhook_url = os.getenv("WEBHOOK_URL")
+        if webhook_url:
+            # Telegram присылает секрет в заголовке X-Telegram-Bot-Api-Secret-Token;
+            # без него любой мог бы прислать на endpoint поддельный апдейт от чужого user_id
+            secret = os.getenv("WEBHOOK_SECRET")
+            if not secret:
+                raise RuntimeError("Для webhook нужен WEBHOOK_SECRET в .env")
+            self.application.run_webhook(
+                listen=os.getenv("WEBHOOK_LISTEN", "0.0.0.0"),
+                port=int(os.getenv("PORT", "8080")),
+                # Сервер слушает тот же путь, что указан в WEBHOOK_URL (например, https://host/<path>)
+                url_path=urlparse(webhook_url).path.lstrip('/'),
+                secret_token=secret,
+                webhook_url=webhook_url,
+                allowed_updates=[Update.MESSAGE],
+            )
+        else:
+            self.application.run_polling(allowed_updates=[Update.MESSAGE])